@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 """Generates SVG and/or PDF files for a set of cards specified in a CSV file.
 
@@ -17,37 +17,65 @@ Run this script with the --help option for help. Example usage:
 python card_templater.py example_files/template.svg --csv=example_files/cards.csv
 """
 
-from __future__ import print_function
-
 import argparse
-import copy
-import math
+import csv
+import itertools
 import multiprocessing
 import os
+import queue
 import re
 import subprocess
 import sys
 import tempfile
 import threading
 import time
-import xml.etree.ElementTree as ET
+
+from concurrent import futures
+from xml.sax import saxutils
+
+try:
+  from lxml import etree as ET
+except ImportError:
+  import xml.etree.ElementTree as ET
+
+try:
+  import cairosvg
+except (ImportError, OSError):
+  # The cairosvg wheel raises OSError at import when native libcairo is
+  # missing; degrade to the inkscape fallback either way.
+  cairosvg = None
+
+try:
+  import pypdf
+except ImportError:
+  pypdf = None
 
 GRID_FRACTION = 0.3
-TEMPLATE_REGEX = re.compile('\[%(\d+)\]')  # e.g. [%1]
-SUBSVG_REGEX = re.compile('\[(.*%(\d+)\.svg)\]')  # e.g. [subdir/%1.svg]
+TEMPLATE_REGEX = re.compile(r'\[%(\d+)\]')  # e.g. [%1]
+SUBSVG_REGEX = re.compile(r'\[(.*%(\d+)\.svg)\]')  # e.g. [subdir/%1.svg]
+# Column placeholders plus the synthetic x/y offset slots used by the
+# string-rendering fast path.
+STRING_TEMPLATE_REGEX = re.compile(r'\[%(\d+|x|y)\]')
 
 _GLOBAL_PRINT_LOCK = threading.Lock()
 
 
 def parse_csv(fname, sep=',', skip_first=False):
-  """CSV file describing the cards. First column is the card count."""
+  """CSV file describing the cards. First column is the card count.
+
+  Returns (row, count) pairs rather than materializing count aliases of
+  every row; callers expand lazily at render time.
+  """
   result = []
-  with open(fname, 'r') as f:
+  with open(fname, 'r', newline='', encoding='utf-8') as f:
+    reader = csv.reader(f, delimiter=sep)
     if skip_first:
-      f = list(f)[1:]
-    for line in f:
-      tmp = line.strip('\n').split(sep)
-      result.extend([tmp[1:]] * int(tmp[0]))
+      next(reader, None)
+    for row in reader:
+      if row:
+        # Normalize literal \n escapes once per unique row, not per card.
+        result.append(([c.replace('\\n', '\n') for c in row[1:]],
+                       int(row[0])))
   return result
 
 
@@ -69,37 +97,42 @@ def add_vline(root, stroke, x, y, length):
   add_line(root, stroke, x, y, x, y + length)
 
 
+def _cpu_count():
+  """CPUs available to this process; respects cgroup/affinity limits that
+  multiprocessing.cpu_count() (the whole-host count) ignores."""
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return multiprocessing.cpu_count()
+
+
 def _synchronized_print(*args, **kwargs):
   with _GLOBAL_PRINT_LOCK:
     print(*args, **kwargs)
 
 
-def apply_template(text, csv_row):
-  if not text:
-    return None
-  match = TEMPLATE_REGEX.search(text)
-  if match:
-    repl_text = csv_row[int(match.group(1))].replace('\\n', '\n')
-    return TEMPLATE_REGEX.sub(repl_text, text)
-  return None
-
-
-def apply_subsvg(node, csv_row, template_dir):
-  fname = None
-  for attrib, value in node.attrib.iteritems():
-    if 'label' in attrib:
-      match = SUBSVG_REGEX.match(value)
-      if match:
-        fname = match.group(1).replace(
-            '%' + match.group(2), csv_row[int(match.group(2))])
-        fname = os.path.join(template_dir, fname)
-        break
-  if not fname:
-    return False
-  if not os.path.isfile(fname):
-    raise OSError('Templated file \'%s\' does not exist' % fname)
-  dom = ET.ElementTree(file=fname)
-  root = dom.getroot()
+_subsvg_cache = {}  # fname -> (width, height, serialized root bytes, index)
+
+
+def _load_subsvg(fname):
+  """Load an SVG file once, caching its dimensions, serialized form, and
+  placeholder index."""
+  cached = _subsvg_cache.get(fname)
+  if cached is None:
+    if not os.path.isfile(fname):
+      raise OSError('Templated file \'%s\' does not exist' % fname)
+    root = ET.ElementTree(file=fname).getroot()
+    cached = (root.attrib['width'], root.attrib['height'], ET.tostring(root),
+              scan_placeholders(root))
+    _subsvg_cache[fname] = cached
+  return cached
+
+
+def insert_subsvg(node, fname):
+  """Replace node with the contents of the SVG file at fname.
+
+  Returns the placeholder index of the inserted content, with paths
+  relative to node."""
+  width, height, root_bytes, index = _load_subsvg(fname)
   if any(a not in node.attrib for a in ('x', 'y', 'width', 'height')):
     raise ValueError('Sub-SVG placeholder lacks a required x, y, width, or '
                      'height attribute')
@@ -109,57 +142,372 @@ def apply_subsvg(node, csv_row, template_dir):
       'y': node.attrib['y'],
       'width': node.attrib['width'],
       'height': node.attrib['height'],
-      'viewBox': '0 0 %s %s' % (root.attrib['width'], root.attrib['height']),
+      'viewBox': '0 0 %s %s' % (width, height),
       'preserveAspectRatio': 'xMidYMid meet'}
   node.clear()
   node.tag = 'svg'
-  node.attrib = new_attrib
-  node.extend(list(root))
-  return True
+  # lxml's _Element.attrib is a read-only property; update in place.
+  node.attrib.update(new_attrib)
+  node.extend(list(ET.fromstring(root_bytes)))
+  return index
 
 
-def svgs_to_pdfs(svg_fnames, out_base, verbose=False):
-  """Convert each SVG page to PDF in parallel."""
-  pdf_fnames = []
-  processes = []
-  proc_args = []
-  for out in svg_fnames:
-    if len(svg_fnames) > 1:
-      tfile = tempfile.mkstemp(suffix='.pdf')
-      os.close(tfile[0])
-      fname = tfile[1]
+def split_template(text):
+  """Split text into literal/column-index segments, or None if no [%N]."""
+  if not text or '[%' not in text:
+    return None
+  parts = TEMPLATE_REGEX.split(text)
+  if len(parts) == 1:
+    return None
+  return [int(p) if i % 2 else p for i, p in enumerate(parts)]
+
+
+def render_segments(segments, csv_row):
+  """Assemble a split_template result back into a string for one card."""
+  return ''.join(
+      csv_row[s] if isinstance(s, int) else s for s in segments)
+
+
+def template_string_segments(root):
+  """Pre-split the serialized template for pure string-based rendering.
+
+  Placeholders contain no XML-special characters and so survive
+  serialization literally, which lets a card be rendered as a single join
+  of literal segments and substituted values with no per-card parse or
+  serialize at all. Synthetic [%x]/[%y] slots carry the card offset.
+  """
+  root.attrib['x'] = '[%x]'
+  root.attrib['y'] = '[%y]'
+  parts = STRING_TEMPLATE_REGEX.split(ET.tostring(root, encoding='unicode'))
+  return [int(p) if i % 2 and p not in ('x', 'y') else p
+          for i, p in enumerate(parts)]
+
+
+def render_card_string(segments, csv_row, x_str, y_str):
+  """Render one card from template_string_segments output."""
+  out = []
+  for i, seg in enumerate(segments):
+    if i % 2 == 0:
+      out.append(seg)
+    elif seg == 'x':
+      out.append(x_str)
+    elif seg == 'y':
+      out.append(y_str)
+    elif csv_row is None:
+      out.append('[%%%d]' % seg)  # No CSV: leave the placeholder as-is.
     else:
-      fname = '%s.pdf' % out_base
-    pdf_fnames.append(fname)
-    proc_args.append(['inkscape', '--file=%s' % out, '--export-pdf=%s' % fname])
-
-  errors = []
-  def conv():
-    while proc_args and len(errors) == 0:
-      try:
-        args = proc_args.pop(0)
-      except IndexError:
-        pass
-      if verbose:
-        _synchronized_print(
-            'SVG -> PDF (%d)' % (len(pdf_fnames) - len(proc_args)))
-      try:
-        subprocess.check_call(args)
-      except:
-        errors.append(sys.exc_info())
-
-  # Limit conversion processes to CPU count.
-  if verbose:
-    print('Converting individual pages to PDFs...')
+      # Substituted text is escaped for both text and attribute context.
+      out.append(saxutils.escape(csv_row[seg], {'"': '&quot;'}))
+  return ''.join(out)
+
+
+def scan_placeholders(root):
+  """Pre-scan a template tree for placeholder sites.
+
+  The template is identical for every card, so placeholder locations are
+  constant: record them once as (path, ...) tuples, where path is the
+  sequence of child indices from the root, and replay them on each card
+  copy instead of re-walking the whole tree per card.
+
+  Returns (text_sites, attr_sites, subsvg_sites).
+  """
+  text_sites = []    # (path, segments)
+  attr_sites = []    # (path, attrib_name, segments)
+  subsvg_sites = []  # (path, fname_pattern, column, anchor_attrs)
+
+  def scan(node, path):
+    for attrib, value in node.attrib.items():
+      if 'label' in attrib:
+        match = SUBSVG_REGEX.match(value)
+        if match:
+          # The whole node gets replaced so nothing below it can survive,
+          # but its own attributes (x/y/width/height are copied onto the
+          # inserted <svg>) may still hold [%N] placeholders.
+          anchor_attrs = []
+          for a, v in node.attrib.items():
+            segments = split_template(v)
+            if segments:
+              anchor_attrs.append((a, segments))
+          subsvg_sites.append((path, match.group(1), int(match.group(2)),
+                               anchor_attrs))
+          return
+    segments = split_template(node.text)
+    if segments:
+      text_sites.append((path, segments))
+    for attrib, value in node.attrib.items():
+      segments = split_template(value)
+      if segments:
+        attr_sites.append((path, attrib, segments))
+    for i, child in enumerate(node):
+      scan(child, path + (i,))
+
+  scan(root, ())
+  return text_sites, attr_sites, subsvg_sites
+
+
+def _node_at_path(root, path):
+  node = root
+  for i in path:
+    node = node[i]
+  return node
+
+
+def apply_placeholder_index(root, index, csv_row, template_dir):
+  """Replay a scan_placeholders index onto a fresh copy of the template."""
+  text_sites, attr_sites, subsvg_sites = index
+  # Sub-SVGs first: inserted content may carry placeholders of its own,
+  # covered by the (cached) index of the inserted file.
+  for path, fname_pattern, column, anchor_attrs in subsvg_sites:
+    node = _node_at_path(root, path)
+    # Substitute the anchor's own attributes before insert_subsvg copies
+    # x/y/width/height from them.
+    for attrib, segments in anchor_attrs:
+      node.attrib[attrib] = render_segments(segments, csv_row)
+    fname = os.path.join(
+        template_dir,
+        fname_pattern.replace('%%%d' % column, csv_row[column]))
+    sub_index = insert_subsvg(node, fname)
+    apply_placeholder_index(node, sub_index, csv_row, template_dir)
+  for path, segments in text_sites:
+    _node_at_path(root, path).text = render_segments(segments, csv_row)
+  for path, attrib, segments in attr_sites:
+    node = _node_at_path(root, path)
+    node.attrib[attrib] = render_segments(segments, csv_row)
+
+
+_WORKER = {}  # Per-process templating state, set by _init_page_worker.
+
+
+def _build_grid(options, template_width, template_height):
+  """Construct the margin grid, identical for every page, as one group."""
+  horiz_margin = options.units_per_inch * options.horiz_margin
+  vert_margin = options.units_per_inch * options.vert_margin
+  grid = ET.Element('g')
+  for x in range(options.width + 1):
+    add_vline(grid, options.units_per_inch * 0.025,
+              x * template_width + horiz_margin,
+              vert_margin * (1.0 - GRID_FRACTION),
+              vert_margin * GRID_FRACTION)
+    add_vline(grid, options.units_per_inch * 0.025,
+              x * template_width + horiz_margin,
+              options.height * template_height + vert_margin,
+              vert_margin * GRID_FRACTION)
+  for y in range(options.height + 1):
+    add_hline(grid, options.units_per_inch * 0.025,
+              horiz_margin * (1.0 - GRID_FRACTION),
+              y * template_height + vert_margin,
+              horiz_margin * GRID_FRACTION)
+    add_hline(grid, options.units_per_inch * 0.025,
+              options.width * template_width + horiz_margin,
+              y * template_height + vert_margin,
+              horiz_margin * GRID_FRACTION)
+  return grid
+
+
+def _init_page_worker(template_bytes, template_dir, options):
+  """Initialize templating state inherited by every build_page call."""
+  root = ET.fromstring(template_bytes)
+  _WORKER['template_bytes'] = template_bytes
+  _WORKER['template_dir'] = template_dir
+  _WORKER['template_width'] = int(root.attrib['width'])
+  _WORKER['template_height'] = int(root.attrib['height'])
+  _WORKER['index'] = scan_placeholders(root)
+  # Templates without sub-SVGs need no per-card DOM surgery at all; cards
+  # can be rendered by string joins over the pre-split serialized form.
+  if _WORKER['index'][2]:
+    _WORKER['string_segments'] = None
+  else:
+    _WORKER['string_segments'] = template_string_segments(root)
+  _WORKER['options'] = options
+  # The grid is identical on every page: build and serialize it once.
+  if options.no_grid:
+    _WORKER['grid_bytes'] = None
+  else:
+    _WORKER['grid_bytes'] = ET.tostring(_build_grid(
+        options, _WORKER['template_width'], _WORKER['template_height']))
+  # Card offsets depend only on the slot, so the multiply+str per card
+  # folds into one table shared by every page.
+  horiz_margin = options.units_per_inch * options.horiz_margin
+  vert_margin = options.units_per_inch * options.vert_margin
+  _WORKER['slot_offsets'] = [
+      (str(_WORKER['template_width'] * x + horiz_margin),
+       str(_WORKER['template_height'] * y + vert_margin))
+      for x, y in itertools.product(range(options.width),
+                                    range(options.height))]
+
+
+def build_page(job):
+  """Construct a single page and return it as a list of SVG byte chunks.
+
+  job is a (page_num, csv_rows) tuple, where csv_rows holds the card rows
+  for this page or is None to lay out unmodified template copies.
+
+  The page is assembled as serialized chunks instead of one large DOM so
+  each card subtree can be garbage-collected as soon as it is emitted;
+  peak memory stays at one template copy regardless of cards per page.
+  """
+  page_num, csv_rows = job
+  options = _WORKER['options']
+  template_width = _WORKER['template_width']
+  template_height = _WORKER['template_height']
+  horiz_margin = options.units_per_inch * options.horiz_margin
+  vert_margin = options.units_per_inch * options.vert_margin
+
+  page_width = template_width * int(options.width) + 2 * horiz_margin
+  page_height = template_height * int(options.height) + 2 * vert_margin
+  header = ('<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s"'
+            % (page_width, page_height))
+  if options.single_file and not options.pdf:
+    # Pages stack vertically inside one outer <svg>.
+    header += ' y="%s"' % (page_num * page_height)
+  chunks = [(header + '>').encode('ascii')]
+  if _WORKER['grid_bytes'] is not None:
+    chunks.append(_WORKER['grid_bytes'])
+
+  # Construct page. islice over the precomputed slot offsets terminates
+  # exactly when the cards run out, instead of re-testing a bound that
+  # only broke the inner loop.
+  card_count = len(csv_rows) if csv_rows else options.width * options.height
+  slots = itertools.islice(_WORKER['slot_offsets'], card_count)
+  for index, (x_str, y_str) in enumerate(slots):
+    if _WORKER['string_segments'] is not None:
+      chunks.append(render_card_string(
+          _WORKER['string_segments'],
+          csv_rows[index] if csv_rows else None,
+          x_str, y_str).encode('utf-8'))
+      continue
+    # Re-parsing the serialized template (expat, C) is much faster than
+    # copy.deepcopy, which clones every node in pure Python.
+    doc_copy = ET.fromstring(_WORKER['template_bytes'])
+    # Set offset.
+    doc_copy.attrib['x'] = x_str
+    doc_copy.attrib['y'] = y_str
+    if csv_rows:
+      # Substitute templates at the pre-scanned placeholder sites.
+      apply_placeholder_index(doc_copy, _WORKER['index'], csv_rows[index],
+                              _WORKER['template_dir'])
+    chunks.append(ET.tostring(doc_copy))
+  chunks.append(b'</svg>')
+  return chunks
+
+
+def _write_page(fname, page_chunks):
+  """Write one page's chunks in large buffered writes."""
+  with open(fname, 'wb', buffering=1 << 20) as out:
+    out.writelines(page_chunks)
+
+
+def _read_until_prompt(proc):
+  """Consume inkscape --shell output until the next '>' prompt appears."""
+  out = ''
+  while not out.endswith('>'):
+    char = proc.stdout.read(1)
+    if not char:
+      raise OSError('inkscape --shell exited unexpectedly')
+    out += char
+  return out
+
+
+def _run_conversion_threads(target, count, errors):
+  """Run count copies of target in threads and re-raise any stored error."""
   threads = []
-  for _ in xrange(multiprocessing.cpu_count()):
-    thread = threading.Thread(target=conv)
+  for _ in range(count):
+    thread = threading.Thread(target=target)
     thread.start()
     threads.append(thread)
   for thread in threads:
     thread.join()
   for error in errors:
-    raise error[0], error[1], error[2]
+    raise error[1].with_traceback(error[2])
+
+
+def _cairosvg_to_pdfs(svg_pages, pdf_fnames, verbose=False):
+  """Render serialized SVG pages to PDFs in-process with cairosvg."""
+  completed = [0]
+  def conv(pair):
+    page, pdf = pair
+    cairosvg.svg2pdf(bytestring=page, write_to=pdf)
+    if verbose:
+      completed[0] += 1
+      _synchronized_print('SVG -> PDF (%d)' % completed[0])
+
+  # Exceptions raised in workers propagate naturally out of map.
+  with futures.ThreadPoolExecutor(
+      max_workers=min(_cpu_count(), len(pdf_fnames))) as pool:
+    list(pool.map(conv, zip(svg_pages, pdf_fnames)))
+
+
+def _inkscape_to_pdfs(svg_pages, pdf_fnames, verbose=False):
+  """Convert SVG pages to PDFs via batched inkscape --shell sessions.
+
+  A single inkscape process handles many pages, so its startup cost (font
+  cache, extensions) is paid once per worker instead of once per page.
+  """
+  pairs = queue.Queue()
+  for page, pdf in zip(svg_pages, pdf_fnames):
+    tfile = tempfile.mkstemp(suffix='.svg')
+    os.write(tfile[0], page)
+    os.close(tfile[0])
+    pairs.put((tfile[1], pdf))
+
+  errors = []
+  def conv():
+    proc = None
+    try:
+      proc = subprocess.Popen(['inkscape', '--shell'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              universal_newlines=True)
+      _read_until_prompt(proc)
+      while len(errors) == 0:
+        try:
+          svg, pdf = pairs.get_nowait()
+        except queue.Empty:
+          break
+        if verbose:
+          _synchronized_print(
+              'SVG -> PDF (%d)' % (len(pdf_fnames) - pairs.qsize()))
+        proc.stdin.write('file-open:%s; export-filename:%s; export-do; '
+                         'file-close;\n' % (svg, pdf))
+        proc.stdin.flush()
+        _read_until_prompt(proc)
+        os.unlink(svg)  # The temp page SVG is not needed past conversion.
+    except:
+      errors.append(sys.exc_info())
+    finally:
+      if proc is not None:
+        try:
+          proc.stdin.write('quit\n')
+          proc.stdin.close()
+          proc.wait()
+        except Exception:
+          pass
+
+  # Limit conversion workers (one inkscape process each) to CPU count.
+  _run_conversion_threads(
+      conv, min(_cpu_count(), len(pdf_fnames)), errors)
+
+
+def svgs_to_pdfs(svg_pages, out_base, verbose=False):
+  """Convert each serialized SVG page to a PDF in parallel.
+
+  Prefers the in-process cairosvg renderer when installed, avoiding any
+  subprocess and temp-SVG round-trip; otherwise falls back to inkscape.
+  """
+  pdf_fnames = []
+  for _ in svg_pages:
+    if len(svg_pages) > 1:
+      tfile = tempfile.mkstemp(suffix='.pdf')
+      os.close(tfile[0])
+      pdf_fnames.append(tfile[1])
+    else:
+      pdf_fnames.append('%s.pdf' % out_base)
+
+  if verbose:
+    print('Converting individual pages to PDFs...')
+  if cairosvg is not None:
+    _cairosvg_to_pdfs(svg_pages, pdf_fnames, verbose)
+  else:
+    _inkscape_to_pdfs(svg_pages, pdf_fnames, verbose)
   return pdf_fnames
 
 
@@ -168,13 +516,21 @@ def merge_pdfs(pdf_fnames, out_base, verbose=False):
   if len(pdf_fnames) > 1:
     if verbose:
       print('Merging individual PDF files...')
+    if pypdf is not None:
+      # Merge in-process; the temp PDFs were just written, so re-reading
+      # them through a subprocess round-trip is pure overhead.
+      writer = pypdf.PdfWriter()
+      for fname in pdf_fnames:
+        writer.append(fname)
+      writer.write('%s.pdf' % out_base)
+      return
     pdfunite = ['pdfunite']
     pdfunite.extend(pdf_fnames)
     pdfunite.append('%s.pdf' % out_base)
     try:
       subprocess.check_call(pdfunite)
     except OSError as e:
-      raise OSError('pdfunite must be installed and in your path.')
+      raise OSError('pypdf or pdfunite must be installed.')
 
 
 def main():
@@ -192,6 +548,10 @@ def main():
                       help='optional output filename base, defaults to out')
   parser.add_argument('--pdf', default=False, action='store_true',
                       help='output a single PDF file, defaults to SVG files')
+  parser.add_argument('--single-file', default=False, action='store_true',
+                      help='write all pages into one SVG file instead of one '
+                           'file per page (ignored with --pdf, which already '
+                           'merges)')
   parser.add_argument('--no-grid', default=False, action='store_true',
                       help='Do not render a grid in the margins')
   parser.add_argument('--width', type=int, default=4,
@@ -217,105 +577,105 @@ def main():
     raise Exception('The arguments provided would just output the identical '
                     'template SVG file... did you mean to use --csv or --pdf?')
 
-  # Constants.
-  horiz_margin = args.units_per_inch * args.horiz_margin
-  vert_margin = args.units_per_inch * args.vert_margin
-
   # Parse cards from input CSV file.
   if args.csv:
     csv = parse_csv(args.csv, args.csv_sep, skip_first=args.csv_skip_first)
+    if not csv:
+      raise Exception('No cards found in %s... is the file empty, or did '
+                      '--csv-skip-first discard the only line?' % args.csv)
   else:
     csv = None
-  card_count = len(csv) if csv else args.width * args.height
-  digits = int(math.log10(card_count))  # Used to pad output filename.
 
   # Template file.
   dom = ET.ElementTree(file=args.template)
-  template_width = int(dom.getroot().attrib['width'])
-  template_height = int(dom.getroot().attrib['height'])
+  template_bytes = ET.tostring(dom.getroot())
   template_dir = os.path.abspath(os.path.dirname(args.template))
 
-  # Construct all pages.
-  index = 0
+  # Split the deck into one job per page.
+  cards_per_page = args.width * args.height
+  page_jobs = []
+  if csv:
+    cards = itertools.chain.from_iterable(
+        itertools.repeat(row, count) for row, count in csv)
+    while True:
+      page_rows = list(itertools.islice(cards, cards_per_page))
+      if not page_rows:
+        break
+      page_jobs.append((len(page_jobs), page_rows))
+  else:
+    page_jobs.append((0, None))
+  if args.pages:
+    page_jobs = page_jobs[:args.pages]
+
+  # Pad output filenames to the width of the largest page number. The old
+  # int(math.log10(card_count)) was one digit short and crashed on empty
+  # decks.
+  digits = len(str(max(1, len(page_jobs) - 1)))
+  # Escape the user-supplied base so braces in it survive format().
+  out_base = args.out.replace('{', '{{').replace('}', '}}')
+  fname_fmt = f'{out_base}_{{:0{digits}d}}.svg'
+
+  # Construct pages in parallel; each page is independent. With the fork
+  # start method, workers inherit the parsed template, placeholder index,
+  # and grid copy-on-write from the parent, so only the small per-page CSV
+  # slices cross the process boundary; elsewhere each worker rebuilds the
+  # state from the pickled initargs.
+  if 'fork' in multiprocessing.get_all_start_methods():
+    _init_page_worker(template_bytes, template_dir, args)
+    pool = multiprocessing.get_context('fork').Pool(
+        min(_cpu_count(), len(page_jobs)))
+  else:
+    pool = multiprocessing.Pool(
+        min(_cpu_count(), len(page_jobs)),
+        initializer=_init_page_worker,
+        initargs=(template_bytes, template_dir, args))
   filenum = 0
-  output_fnames = []
-  while (index < card_count and
-      (not args.pages or len(output_fnames) < args.pages)):
-    if args.verbose:
-      print('Templating SVG page (%d)' % (len(output_fnames) + 1))
-    # New SVG DOM.
-    root = ET.Element('svg', {'xmlns': 'http://www.w3.org/2000/svg'})
-    dom_out = ET.ElementTree(element=root)
-    root.attrib['width'] = str(template_width * int(args.width) +
-                               2 * horiz_margin)
-    root.attrib['height'] = str(template_height * int(args.height) +
-                                2 * vert_margin)
-
-    # Optionally construct grid.
-    if not args.no_grid:
-      for x in xrange(args.width + 1):
-        add_vline(root, args.units_per_inch * 0.025,
-                  x * template_width + horiz_margin,
-                  vert_margin * (1.0 - GRID_FRACTION),
-                  vert_margin * GRID_FRACTION)
-        add_vline(root, args.units_per_inch * 0.025,
-                  x * template_width + horiz_margin,
-                  args.height * template_height + vert_margin,
-                  vert_margin * GRID_FRACTION)
-      for y in xrange(args.height + 1):
-        add_hline(root, args.units_per_inch * 0.025,
-                  horiz_margin * (1.0 - GRID_FRACTION),
-                  y * template_height + vert_margin,
-                  horiz_margin * GRID_FRACTION)
-        add_hline(root, args.units_per_inch * 0.025,
-                  args.width * template_width + horiz_margin,
-                  y * template_height + vert_margin,
-                  horiz_margin * GRID_FRACTION)
-
-    # Construct page.
-    for x in xrange(args.width):
-      for y in xrange(args.height):
-        if index == card_count:
-          break
-        doc_copy = copy.deepcopy(dom.getroot())
-        # Set offset.
-        doc_copy.attrib['x'] = str(template_width * x + horiz_margin)
-        doc_copy.attrib['y'] = str(template_height * y + vert_margin)
-        if csv:
-          # Substitute templates.
-          templating_complete = False
-          while not templating_complete:  # Support recursive templating.
-            templating_complete = True
-            for node in doc_copy.iter():
-              if apply_subsvg(node, csv[index], template_dir):
-                templating_complete = False
-              repl_text = apply_template(node.text, csv[index])
-              if repl_text is not None:
-                node.text = repl_text
-                templating_complete = False
-              for attrib, value in node.attrib.iteritems():
-                repl_text = apply_template(value, csv[index])
-                if repl_text is not None:
-                  node.attrib[attrib] = repl_text
-                  templating_complete = False
-        root.append(doc_copy)
-        index +=1
-
-    # Write output SVG file for the page.
-    if args.pdf:
-      with tempfile.NamedTemporaryFile(suffix='.svg', delete=False) as out:
-        dom_out.write(out)
-        output_fnames.append(out.name)
-    else:
-      fname = '%s_%s.svg' % (args.out, str(filenum).zfill(digits))
-      with open(fname, 'w') as out:
-        dom_out.write(out)
-      output_fnames.append(fname)
-    filenum += 1
+  outputs = []  # Serialized page bytes in PDF mode, SVG filenames otherwise.
+  writes = []
+  if args.single_file and not args.pdf:
+    # One output stream: pages nest as <svg y="..."> blocks inside a
+    # single outer document, avoiding per-page open/close round-trips.
+    template_root = dom.getroot()
+    page_width = (int(template_root.attrib['width']) * args.width +
+                  2 * args.units_per_inch * args.horiz_margin)
+    page_height = (int(template_root.attrib['height']) * args.height +
+                   2 * args.units_per_inch * args.vert_margin)
+    fname = '%s.svg' % args.out
+    with open(fname, 'wb', buffering=1 << 20) as out:
+      out.write(('<svg xmlns="http://www.w3.org/2000/svg" '
+                 'width="%s" height="%s">'
+                 % (page_width, page_height * len(page_jobs))
+                 ).encode('ascii'))
+      for page_chunks in pool.imap(build_page, page_jobs):
+        if args.verbose:
+          print('Templated SVG page (%d)' % (filenum + 1))
+        out.writelines(page_chunks)
+        filenum += 1
+      out.write(b'</svg>')
+    outputs.append(fname)
+  else:
+    # File writes release the GIL, so overlapping them with page
+    # generation in a small thread pool gives real I/O parallelism.
+    with futures.ThreadPoolExecutor(
+        max_workers=min(8, _cpu_count())) as writer:
+      for page_chunks in pool.imap(build_page, page_jobs):
+        if args.verbose:
+          print('Templated SVG page (%d)' % (filenum + 1))
+        if args.pdf:
+          outputs.append(b''.join(page_chunks))
+        else:
+          fname = fname_fmt.format(filenum)
+          writes.append(writer.submit(_write_page, fname, page_chunks))
+          outputs.append(fname)
+        filenum += 1
+  pool.close()
+  pool.join()
+  for write in writes:
+    write.result()  # Surface any write error.
 
   # Optionally generate merged PDF.
   if args.pdf:
-    pdf_fnames = svgs_to_pdfs(output_fnames, args.out, args.verbose)
+    pdf_fnames = svgs_to_pdfs(outputs, args.out, args.verbose)
     merge_pdfs(pdf_fnames, args.out, args.verbose)
     if args.verbose:
       print('Final merged file: %s.pdf\nDone.' % args.out)